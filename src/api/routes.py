@@ -1,15 +1,50 @@
-from typing import Any, Dict, List, Optional
+import time
+from typing import Any, Dict, Hashable, List, Optional, Tuple
 
-from aiogram import Bot
-from fastapi import Depends, FastAPI, Header, HTTPException, Query
+from aiogram import Bot, Dispatcher
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
 from pydantic import BaseModel, Field
 
 from config.settings import Settings
-from db.database import Database
+from db.database import Database, format_timestamp
 
+BALANCE_CACHE_TTL = 5.0
+TOP_CACHE_TTL = 30.0
+RESPONSE_CACHE_MAX_ENTRIES = 10_000
 
-def create_api_app(settings: Settings, db: Database, bot: Bot) -> FastAPI:
+
+class ResponseCache:
+    """In-process TTL cache for read-only responses.
+
+    Entries are tagged with ``Database.generation`` at read time, so any committed
+    write makes them stale immediately; the TTL only bounds staleness for writes
+    made by other processes sharing the same database file.
+    """
+
+    def __init__(self, db: Database, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self._db = db
+        self._max_entries = max_entries
+        self._entries: Dict[Hashable, Tuple[float, int, Any]] = {}
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, generation, value = entry
+        if generation != self._db.generation or time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float, generation: int) -> None:
+        if len(self._entries) >= self._max_entries:
+            self._entries.clear()
+        self._entries[key] = (time.monotonic() + ttl, generation, value)
+
+
+def create_api_app(settings: Settings, db: Database, bot: Bot, dp: Dispatcher) -> FastAPI:
     app = FastAPI(title="Stars Internal API", version="1.0.0")
+    cache = ResponseCache(db)
 
     async def require_token(authorization: Optional[str] = Header(default=None)) -> None:
         if not authorization or not authorization.startswith("Bearer "):
@@ -27,26 +62,45 @@ def create_api_app(settings: Settings, db: Database, bot: Bot) -> FastAPI:
         user_id: int,
         _=Depends(require_token),
     ) -> Dict[str, Any]:
-        balance = await db.get_balance(user_id)
-        return {"user_id": user_id, "balance": balance}
+        key = ("balance", user_id)
+        response = cache.get(key)
+        if response is None:
+            generation = db.generation
+            balance = await db.get_balance(user_id)
+            response = {"user_id": user_id, "balance": balance}
+            cache.set(key, response, BALANCE_CACHE_TTL, generation)
+        return response
 
     @app.get("/transactions/{user_id}")
     async def get_transactions(
         user_id: int,
         limit: int = Query(default=20, ge=1, le=50),
         offset: int = Query(default=0, ge=0),
+        before_id: Optional[int] = Query(default=None, ge=1),
         _=Depends(require_token),
     ) -> Dict[str, Any]:
-        items = await db.get_transactions(user_id, limit=limit, offset=offset)
-        return {"user_id": user_id, "items": items}
+        # Pass next_before_id back as before_id to page without OFFSET.
+        items = await db.get_transactions(user_id, limit=limit, offset=offset, before_id=before_id)
+        next_before_id = items[-1].id if len(items) == limit else None
+        return {
+            "user_id": user_id,
+            "items": [{**tx._asdict(), "created_at": format_timestamp(tx.created_at)} for tx in items],
+            "next_before_id": next_before_id,
+        }
 
     @app.get("/top")
     async def get_top(
         limit: int = Query(default=10, ge=1, le=50),
         _=Depends(require_token),
     ) -> Dict[str, List[Dict[str, Any]]]:
-        items = await db.top_balances(limit=limit)
-        return {"items": items}
+        key = ("top", limit)
+        response = cache.get(key)
+        if response is None:
+            generation = db.generation
+            items = await db.top_balances(limit=limit)
+            response = {"items": [entry._asdict() for entry in items]}
+            cache.set(key, response, TOP_CACHE_TTL, generation)
+        return response
 
     class DebitRequest(BaseModel):
         user_id: int = Field(..., ge=1)
@@ -70,4 +124,16 @@ def create_api_app(settings: Settings, db: Database, bot: Bot) -> FastAPI:
             raise HTTPException(status_code=502, detail=f"Telegram error: {exc}") from exc
         return result
 
+    if settings.use_webhook:
+
+        @app.post(settings.webhook_path, include_in_schema=False)
+        async def telegram_webhook(
+            request: Request,
+            x_telegram_bot_api_secret_token: Optional[str] = Header(default=None),
+        ) -> Dict[str, Any]:
+            if x_telegram_bot_api_secret_token != settings.webhook_secret:
+                raise HTTPException(status_code=403, detail="Invalid secret token")
+            await dp.feed_webhook_update(bot, await request.json())
+            return {"ok": True}
+
     return app
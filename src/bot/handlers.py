@@ -1,14 +1,17 @@
+import asyncio
 import logging
+import re
 import time
-from typing import Optional
+from typing import Awaitable, Callable, Dict, Optional
 
-from aiogram import Bot, F, Router
+from aiogram import F, Router
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
-from aiogram.types import CallbackQuery, LabeledPrice, Message, PreCheckoutQuery
+from aiogram.types import CallbackQuery, InlineKeyboardMarkup, LabeledPrice, Message, PreCheckoutQuery
 
 from bot import keyboards, texts
+from bot.middlewares import BackgroundMiddleware
 from bot.states import GiftStates
 from config.logger import log_extra
 from config.settings import Settings
@@ -16,21 +19,31 @@ from db.database import Database
 
 CURRENCY = "XTR"
 PAGE_SIZE = 20
+BACKGROUND_LIMIT = 512
+
+_GIFT_RE = re.compile(r"^gift:(\d+):(\d+)$")
+_REFUND_RE = re.compile(r"^refund:(\d+)$")
+_BUY_RE = re.compile(r"^buy:(\d+)$")
+_HISTORY_RE = re.compile(r"^menu:history:(\d+)(?::(\d+))?$")
+
+CallbackHandler = Callable[[CallbackQuery, FSMContext], Awaitable[None]]
 
 logger = logging.getLogger(__name__)
 
 
 def setup_handlers(router: Router, db: Database, settings: Settings) -> None:
+    router.callback_query.outer_middleware(BackgroundMiddleware(BACKGROUND_LIMIT))
+    main_menu_kb = keyboards.main_menu(include_test=settings.test_mode)
+
     @router.message(CommandStart())
     async def cmd_start(message: Message, state: FSMContext) -> None:
         await state.clear()
-        await db.ensure_user(message.from_user.id, message.from_user.username)
+        await db.ensure_user_returning_balance(message.from_user.id, message.from_user.username)
         await message.answer(
             texts.WELCOME,
-            reply_markup=keyboards.main_menu(include_test=settings.test_mode),
+            reply_markup=main_menu_kb,
         )
 
-    @router.callback_query(F.data == "menu:root")
     async def menu_root(callback: CallbackQuery, state: FSMContext) -> None:
         await state.clear()
         await callback.answer()
@@ -38,16 +51,14 @@ def setup_handlers(router: Router, db: Database, settings: Settings) -> None:
             await safe_edit(
                 callback.message,
                 texts.WELCOME,
-                keyboards.main_menu(include_test=settings.test_mode),
+                main_menu_kb,
             )
 
-    @router.callback_query(F.data == "menu:buy")
-    async def menu_buy(callback: CallbackQuery) -> None:
+    async def menu_buy(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer()
         if callback.message:
-            await safe_edit(callback.message, "Выберите пакет Stars для оплаты:", keyboards.buy_packs_keyboard())
+            await safe_edit(callback.message, "Выберите пакет Stars для оплаты:", keyboards.BUY_PACKS_KB)
 
-    @router.callback_query(F.data == "menu:gift")
     async def menu_gift(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer()
         await state.set_state(GiftStates.waiting_for_recipient)
@@ -60,39 +71,33 @@ def setup_handlers(router: Router, db: Database, settings: Settings) -> None:
             await safe_edit(
                 callback.message,
                 text,
-                keyboards.main_menu(include_test=settings.test_mode),
+                main_menu_kb,
             )
 
-    @router.callback_query(F.data.startswith("menu:history:"))
-    async def menu_history(callback: CallbackQuery) -> None:
+    async def menu_history(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer()
-        parts = callback.data.split(":")
-        try:
-            page = int(parts[-1]) if len(parts) == 3 else 0
-        except ValueError:
-            page = 0
-        page = max(page, 0)
-        await send_history(callback, db, page)
-
-    @router.callback_query(F.data == "menu:help")
-    async def menu_help(callback: CallbackQuery) -> None:
+        m = _HISTORY_RE.match(callback.data)
+        page = int(m[1]) if m else 0
+        before_id = int(m[2]) if m and m[2] else None
+        await send_history(callback, db, page, before_id)
+
+    async def menu_help(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer()
         if callback.message:
             await safe_edit(
                 callback.message,
                 texts.HELP,
-                keyboards.main_menu(include_test=settings.test_mode),
+                main_menu_kb,
             )
 
-    @router.callback_query(F.data == "menu:balance")
-    async def menu_balance(callback: CallbackQuery) -> None:
+    async def menu_balance(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer()
         bal = await db.get_balance(callback.from_user.id)
         if callback.message:
             await safe_edit(
                 callback.message,
                 texts.balance_text(callback.from_user.id, bal),
-                keyboards.main_menu(include_test=settings.test_mode),
+                main_menu_kb,
             )
 
     @router.message(GiftStates.waiting_for_recipient)
@@ -112,25 +117,19 @@ def setup_handlers(router: Router, db: Database, settings: Settings) -> None:
             reply_markup=keyboards.gift_amount_keyboard(recipient_id),
         )
 
-    @router.callback_query(F.data.startswith("gift:"))
-    async def gift_amount(callback: CallbackQuery) -> None:
-        await callback.answer()
-        parts = callback.data.split(":")
-        if len(parts) != 3:
+    async def gift_amount(callback: CallbackQuery, state: FSMContext) -> None:
+        m = _GIFT_RE.match(callback.data)
+        if not m:
             await callback.answer("Некорректная команда", show_alert=True)
             return
-        recipient_id, amount = int(parts[1]), int(parts[2])
+        recipient_id, amount = int(m[1]), int(m[2])
         sender_id = callback.from_user.id
         if recipient_id == sender_id:
             await callback.answer("Нельзя отправить Stars самому себе", show_alert=True)
             return
 
-        balance = await db.get_balance(sender_id)
-        if balance < amount:
-            await callback.answer("Недостаточно Stars на балансе бота.", show_alert=True)
-            return
         try:
-            await db.transfer(
+            new_balance = await db.transfer(
                 from_user=sender_id,
                 to_user=recipient_id,
                 amount=amount,
@@ -138,26 +137,27 @@ def setup_handlers(router: Router, db: Database, settings: Settings) -> None:
                 to_username=None,
             )
         except ValueError as exc:
+            if str(exc) == "insufficient_funds":
+                await callback.answer("Недостаточно Stars на балансе бота.", show_alert=True)
+                return
             logger.warning("transfer failed", extra=log_extra(error=str(exc)))
             await callback.answer("Не удалось выполнить перевод. Попробуйте позже.", show_alert=True)
             return
 
-        new_balance = await db.get_balance(sender_id)
+        await callback.answer(cache_time=1)
         if callback.message:
             await callback.message.edit_text(
                 f"Готово! Отправлено {amount}⭐ пользователю <code>{recipient_id}</code>.\n"
                 f"Ваш баланс в боте: {new_balance}⭐",
-                reply_markup=keyboards.main_menu(include_test=settings.test_mode),
+                reply_markup=main_menu_kb,
             )
 
-    @router.callback_query(F.data.startswith("refund:"))
-    async def refund(callback: CallbackQuery) -> None:
-        await callback.answer()
-        try:
-            amount = int(callback.data.split(":")[1])
-        except (ValueError, IndexError):
+    async def refund(callback: CallbackQuery, state: FSMContext) -> None:
+        m = _REFUND_RE.match(callback.data)
+        if not m:
             await callback.answer("Некорректная сумма", show_alert=True)
             return
+        amount = int(m[1])
 
         user_id = callback.from_user.id
         payment = await db.get_payment_for_amount(user_id, amount)
@@ -167,7 +167,7 @@ def setup_handlers(router: Router, db: Database, settings: Settings) -> None:
 
         try:
             ok = await callback.bot.refund_star_payment(
-                user_id=user_id, telegram_payment_charge_id=payment["charge_id"]
+                user_id=user_id, telegram_payment_charge_id=payment.charge_id
             )
         except Exception as exc:  # pragma: no cover - Telegram failure
             logger.error("refund failed", extra=log_extra(error=str(exc), user_id=user_id))
@@ -178,27 +178,26 @@ def setup_handlers(router: Router, db: Database, settings: Settings) -> None:
             await callback.answer("Telegram отказал в возврате.", show_alert=True)
             return
 
-        success = await db.mark_refund(user_id=user_id, charge_id=payment["charge_id"], amount=amount)
+        success = await db.mark_refund(user_id=user_id, charge_id=payment.charge_id, amount=amount)
         if not success:
             await callback.answer("Не удалось отметить возврат в базе.", show_alert=True)
             return
 
+        await callback.answer(cache_time=1)
         balance = await db.get_balance(user_id)
         if callback.message:
             await callback.message.edit_text(
                 f"Возврат {amount}⭐ выполнен.\nТекущий баланс в боте: {balance}⭐",
-                reply_markup=keyboards.main_menu(include_test=settings.test_mode),
+                reply_markup=main_menu_kb,
             )
 
-    @router.callback_query(F.data.startswith("buy:"))
-    async def buy_stars(callback: CallbackQuery) -> None:
-        await callback.answer()
-        try:
-            amount = int(callback.data.split(":")[1])
-        except (ValueError, IndexError):
+    async def buy_stars(callback: CallbackQuery, state: FSMContext) -> None:
+        m = _BUY_RE.match(callback.data)
+        if not m:
             await callback.answer("Некорректная сумма", show_alert=True)
             return
-        if amount not in keyboards.BUY_PACKS:
+        amount = int(m[1])
+        if amount not in keyboards.BUY_PACKS_SET:
             await callback.answer("Сумма недоступна", show_alert=True)
             return
 
@@ -218,6 +217,8 @@ def setup_handlers(router: Router, db: Database, settings: Settings) -> None:
         except TelegramBadRequest as exc:
             logger.error("failed to send invoice", extra=log_extra(error=str(exc)))
             await callback.answer("Не удалось создать счёт. Попробуйте позже.", show_alert=True)
+            return
+        await callback.answer(cache_time=1)
 
     @router.pre_checkout_query()
     async def pre_checkout(pre_checkout_query: PreCheckoutQuery) -> None:
@@ -225,16 +226,17 @@ def setup_handlers(router: Router, db: Database, settings: Settings) -> None:
             await pre_checkout_query.answer(ok=False, error_message="Требуется валюта XTR (Stars).")
             return
         payload = pre_checkout_query.invoice_payload or ""
-        parts = payload.split(":")
-        if len(parts) != 3 or parts[0] != "buy":
+        action, _, rest = payload.partition(":")
+        amount_raw, _, user_raw = rest.partition(":")
+        if action != "buy" or not amount_raw.isdigit() or not user_raw.isdigit():
             await pre_checkout_query.answer(ok=False, error_message="Некорректный payload.")
             return
-        amount = int(parts[1])
-        user_from_payload = int(parts[2])
+        amount = int(amount_raw)
+        user_from_payload = int(user_raw)
         if amount != pre_checkout_query.total_amount or user_from_payload != pre_checkout_query.from_user.id:
             await pre_checkout_query.answer(ok=False, error_message="Проверка суммы не пройдена.")
             return
-        if amount not in keyboards.BUY_PACKS:
+        if amount not in keyboards.BUY_PACKS_SET:
             await pre_checkout_query.answer(ok=False, error_message="Некорректная сумма.")
             return
         await pre_checkout_query.answer(ok=True)
@@ -248,94 +250,140 @@ def setup_handlers(router: Router, db: Database, settings: Settings) -> None:
         amount = payment.total_amount
         charge_id = payment.telegram_payment_charge_id
 
-        created = await db.add_purchase(user_id, message.from_user.username, amount, charge_id)
-        if not created:
+        balance = await db.add_purchase(user_id, message.from_user.username, amount, charge_id)
+        if balance is None:
             await message.answer("Этот платёж уже обработан.")
             return
 
-        balance = await db.get_balance(user_id)
         await message.answer(
             f"Покупка успешна! +{amount}⭐ зачислено на баланс.\nВаш баланс в боте: {balance}⭐",
-            reply_markup=keyboards.main_menu(include_test=settings.test_mode),
+            reply_markup=main_menu_kb,
         )
         logger.info(
             "purchase completed",
             extra=log_extra(user_id=user_id, amount=amount, charge_id=charge_id),
         )
 
-    @router.callback_query(F.data == "noop")
-    async def noop(callback: CallbackQuery) -> None:
+    async def noop(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer()
 
-    @router.callback_query(F.data == "test:add50")
-    async def test_add(callback: CallbackQuery) -> None:
+    async def test_add(callback: CallbackQuery, state: FSMContext) -> None:
         if not settings.test_mode:
             await callback.answer("Тестовая кнопка недоступна.", show_alert=True)
             return
 
         await callback.answer("Начислено +50⭐ (тест)")
-        await db.ensure_user(callback.from_user.id, callback.from_user.username)
 
         synthetic_charge = f"test:{callback.from_user.id}:{int(time.time()*1000)}"
-        await db.add_purchase(
+        balance = await db.add_purchase(
             user_id=callback.from_user.id,
             username=callback.from_user.username,
             amount=50,
             charge_id=synthetic_charge,
         )
-        balance = await db.get_balance(callback.from_user.id)
 
         if callback.message:
             await safe_edit(
                 callback.message,
                 f"🧪 Тестовое начисление: +50⭐\nВаш баланс в боте: {balance}⭐",
-                keyboards.main_menu(include_test=settings.test_mode),
+                main_menu_kb,
             )
 
+    callback_handlers: Dict[str, CallbackHandler] = {
+        "menu:root": menu_root,
+        "menu:buy": menu_buy,
+        "menu:gift": menu_gift,
+        "menu:history": menu_history,
+        "menu:help": menu_help,
+        "menu:balance": menu_balance,
+        "gift": gift_amount,
+        "refund": refund,
+        "buy": buy_stars,
+        "noop": noop,
+        "test:add50": test_add,
+    }
+
+    @router.callback_query()
+    async def dispatch_callback(callback: CallbackQuery, state: FSMContext) -> None:
+        handler = resolve_callback(callback_handlers, callback.data or "")
+        if handler is None:
+            await callback.answer()
+            return
+        await handler(callback, state)
+
 
-async def send_history(callback: CallbackQuery, db: Database, page: int) -> None:
+async def send_history(
+    callback: CallbackQuery, db: Database, page: int, before_id: Optional[int] = None
+) -> None:
+    user_id = callback.from_user.id
     offset = page * PAGE_SIZE
-    items = await db.get_transactions(callback.from_user.id, limit=PAGE_SIZE, offset=offset)
-    total = await db.count_transactions(callback.from_user.id)
+    # "→" carries the last id shown and seeks straight to the next page; "←" and
+    # the first page have no cursor and fall back to OFFSET.
+    if before_id is not None:
+        page_items = db.get_transactions(user_id, limit=PAGE_SIZE, before_id=before_id)
+    else:
+        page_items = db.get_transactions(user_id, limit=PAGE_SIZE, offset=offset)
+    items, total, available = await asyncio.gather(
+        page_items,
+        db.count_transactions(user_id),
+        db.refundable_amounts(user_id, keyboards.BUY_PACKS),
+    )
     has_prev = page > 0
     has_next = offset + PAGE_SIZE < total
 
-    refundable: list[int] = []
-    for amount in keyboards.BUY_PACKS:
-        payment = await db.get_payment_for_amount(callback.from_user.id, amount)
-        if payment and amount not in refundable:
-            refundable.append(amount)
+    refundable = [amount for amount in keyboards.BUY_PACKS if amount in available]
 
     if not items:
         text = "История пуста. Совершите покупку или перевод, чтобы увидеть операции."
     else:
-        lines = [texts.history_entry(item) for item in items]
-        text = "🧾 История операций (последние):\n\n" + "\n\n".join(lines)
+        text = "🧾 История операций (последние):\n\n" + "\n\n".join(map(texts.history_entry, items))
 
     if callback.message:
-        try:
-            await callback.message.edit_text(
-                text, reply_markup=keyboards.history_keyboard(page, has_prev, has_next, refundable)
-            )
-        except TelegramBadRequest:
-            await callback.message.answer(
-                text, reply_markup=keyboards.history_keyboard(page, has_prev, has_next, refundable)
-            )
+        next_before_id = items[-1].id if items else None
+        await safe_edit(
+            callback.message,
+            text,
+            keyboards.history_keyboard(page, has_prev, has_next, refundable, next_before_id),
+        )
+
+
+def resolve_callback(handlers: Dict[str, CallbackHandler], data: str) -> Optional[CallbackHandler]:
+    # Exact match for static buttons, then drop trailing arguments one at a time:
+    # "buy:50" -> "buy", "gift:<id>:<amount>" -> "gift",
+    # "menu:history:<page>:<cursor>" -> "menu:history".
+    key = data
+    while key:
+        handler = handlers.get(key)
+        if handler is not None:
+            return handler
+        key = key.rpartition(":")[0]
+    return None
 
 
 def parse_user_ref(raw: str) -> Optional[int]:
     if not raw:
         return None
-    raw = raw.strip()
-    if raw.startswith("@"):
-        raw = raw[1:]
-    if raw.isdigit():
-        return int(raw)
-    return None
+    try:
+        user_id = int(raw.strip().removeprefix("@"))
+    except ValueError:
+        return None
+    return user_id if user_id > 0 else None
+
+
+def markup_buttons(markup: Optional[InlineKeyboardMarkup]) -> Optional[list]:
+    # Incoming models carry a bound Bot, so compare buttons rather than the models.
+    if markup is None:
+        return None
+    return [[(button.text, button.callback_data) for button in row] for row in markup.inline_keyboard]
 
 
 async def safe_edit(message: Message, text: str, reply_markup=None) -> None:
+    # Re-clicking a menu that is already shown would only earn "message is not modified".
+    if message.text == text and markup_buttons(message.reply_markup) == markup_buttons(reply_markup):
+        return
     try:
         await message.edit_text(text, reply_markup=reply_markup)
-    except TelegramBadRequest:
+    except TelegramBadRequest as exc:
+        if "message is not modified" in exc.message:
+            return
         await message.answer(text, reply_markup=reply_markup)
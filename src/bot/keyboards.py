@@ -1,9 +1,16 @@
+from functools import lru_cache
+
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 BUY_PACKS = [50, 100, 250, 500]
+BUY_PACKS_SET = frozenset(BUY_PACKS)
+
+# Static keyboards are cached and shared between handlers: callers must treat
+# the returned markup as read-only.
 
 
+@lru_cache(maxsize=2)
 def main_menu(include_test: bool = False) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -28,6 +35,7 @@ def main_menu(include_test: bool = False) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@lru_cache(maxsize=1)
 def buy_packs_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for amount in BUY_PACKS:
@@ -37,6 +45,10 @@ def buy_packs_keyboard() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+BUY_PACKS_KB = buy_packs_keyboard()
+
+
+@lru_cache(maxsize=1024)
 def gift_amount_keyboard(recipient_id: int) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for amount in BUY_PACKS:
@@ -46,13 +58,20 @@ def gift_amount_keyboard(recipient_id: int) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-def history_keyboard(page: int, has_prev: bool, has_next: bool, refund_amounts: list[int] | None = None) -> InlineKeyboardMarkup:
+def history_keyboard(
+    page: int,
+    has_prev: bool,
+    has_next: bool,
+    refund_amounts: list[int] | None = None,
+    next_before_id: int | None = None,
+) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     if has_prev:
         builder.button(text="←", callback_data=f"menu:history:{page-1}")
     builder.button(text=f"Стр. {page+1}", callback_data="noop")
     if has_next:
-        builder.button(text="→", callback_data=f"menu:history:{page+1}")
+        cursor = f":{next_before_id}" if next_before_id is not None else ""
+        builder.button(text="→", callback_data=f"menu:history:{page+1}{cursor}")
     if refund_amounts:
         for amount in refund_amounts:
             builder.button(text=f"↩️ Вернуть {amount}⭐", callback_data=f"refund:{amount}")
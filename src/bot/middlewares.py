@@ -0,0 +1,44 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Set
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundMiddleware(BaseMiddleware):
+    """Runs handlers as tasks so the dispatcher can move on to the next update.
+
+    At most ``limit`` handlers run at once; past that the dispatcher waits for a
+    free slot, which keeps a burst of button clicks from piling up unbounded tasks.
+    """
+
+    def __init__(self, limit: int = 512) -> None:
+        self._semaphore = asyncio.Semaphore(limit)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> None:
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._run(handler, event, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> None:
+        try:
+            await handler(event, data)
+        except Exception:
+            logger.exception("background handler failed")
+        finally:
+            self._semaphore.release()
@@ -1,3 +1,5 @@
+from db.database import Transaction, format_timestamp
+
 WELCOME = (
     "Привет! Я бот для работы со Stars внутри приложения.\n\n"
     "Что я умею:\n"
@@ -20,21 +22,31 @@ def balance_text(user_id: int, balance: int) -> str:
     return f"💳 Баланс в боте: {balance}⭐\nВаш user_id: <code>{user_id}</code>"
 
 
-def history_entry(row: dict) -> str:
-    emoji = {
-        "purchase": "🟢",
-        "gift_in": "🎁",
-        "gift_out": "📤",
-        "refund": "↩️",
-    }.get(row["type"], "•")
-    direction = {
-        "purchase": "+",
-        "gift_in": "+",
-        "gift_out": "-",
-        "refund": "-",
-    }.get(row["type"], "")
-    amount = row["amount"]
-    related = row.get("related_user_id")
-    related_text = f" | Контрагент: {related}" if related else ""
-    desc = row.get("description") or ""
-    return f"{emoji} {direction}{amount}⭐ ({row['type']}){related_text}\n{desc}\n{row['created_at']}"
+_HISTORY_EMOJI = {
+    "purchase": "🟢",
+    "gift_in": "🎁",
+    "gift_out": "📤",
+    "refund": "↩️",
+}
+_HISTORY_DIRECTION = {
+    "purchase": "+",
+    "gift_in": "+",
+    "gift_out": "-",
+    "refund": "-",
+}
+_HISTORY_TEMPLATE = "{emoji} {direction}{amount}⭐ ({type}){related}\n{description}\n{created_at}"
+
+
+def history_entry(tx: Transaction) -> str:
+    related = tx.related_user_id
+    return _HISTORY_TEMPLATE.format_map(
+        {
+            "emoji": _HISTORY_EMOJI.get(tx.type, "•"),
+            "direction": _HISTORY_DIRECTION.get(tx.type, ""),
+            "amount": tx.amount,
+            "type": tx.type,
+            "related": f" | Контрагент: {related}" if related else "",
+            "description": tx.description or "",
+            "created_at": format_timestamp(tx.created_at),
+        }
+    )
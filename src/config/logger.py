@@ -2,8 +2,10 @@ import logging
 import sys
 from typing import Any, Dict
 
+import orjson
 
-class KeyValueFormatter(logging.Formatter):
+
+class JsonFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
         base = {
             "level": record.levelname.lower(),
@@ -14,12 +16,12 @@ class KeyValueFormatter(logging.Formatter):
             base["exc_info"] = self.formatException(record.exc_info)
         if hasattr(record, "extra_fields"):
             base.update(getattr(record, "extra_fields") or {})
-        return " ".join(f"{k}={v}" for k, v in base.items())
+        return orjson.dumps(base, default=str).decode()
 
 
 def setup_logging(level: str = "INFO") -> None:
     handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(KeyValueFormatter())
+    handler.setFormatter(JsonFormatter())
     root = logging.getLogger()
     root.setLevel(level.upper())
     root.handlers.clear()
@@ -16,9 +16,18 @@ class Settings:
     db_path: str = os.getenv("DB_PATH", "stars.db")
     test_mode: bool = os.getenv("TEST_MODE", "0") == "1"
     log_level: str = os.getenv("LOG_LEVEL", "INFO")
+    webhook_url: str = os.getenv("WEBHOOK_URL", "").rstrip("/")
+    webhook_secret: str = os.getenv("WEBHOOK_SECRET", "")
+    webhook_path: str = "/tg/webhook"
+
+    @property
+    def use_webhook(self) -> bool:
+        return bool(self.webhook_url)
 
     def validate(self) -> None:
         if not self.bot_token:
             raise RuntimeError("BOT_TOKEN is required")
         if not self.api_token:
             raise RuntimeError("API_TOKEN is required")
+        if self.use_webhook and not self.webhook_secret:
+            raise RuntimeError("WEBHOOK_SECRET is required when WEBHOOK_URL is set")
@@ -1,19 +1,27 @@
 from __future__ import annotations
 
+import asyncio
+import logging
 import os
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
 
 import aiosqlite
 
+logger = logging.getLogger(__name__)
 
 CREATE_SQL = """
 CREATE TABLE IF NOT EXISTS users (
     user_id INTEGER PRIMARY KEY,
     username TEXT,
     balance INTEGER NOT NULL DEFAULT 0,
-    created_at TEXT NOT NULL DEFAULT (datetime('now')),
-    updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+    tx_count INTEGER NOT NULL DEFAULT 0,
+    created_at INTEGER NOT NULL DEFAULT (unixepoch()),
+    updated_at INTEGER NOT NULL DEFAULT (unixepoch())
 );
 
 CREATE TABLE IF NOT EXISTS payments (
@@ -23,7 +31,7 @@ CREATE TABLE IF NOT EXISTS payments (
     currency TEXT NOT NULL,
     charge_id TEXT NOT NULL UNIQUE,
     refunded INTEGER NOT NULL DEFAULT 0,
-    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    created_at INTEGER NOT NULL DEFAULT (unixepoch()),
     FOREIGN KEY(user_id) REFERENCES users(user_id)
 );
 
@@ -32,7 +40,7 @@ CREATE TABLE IF NOT EXISTS transfers (
     from_user_id INTEGER NOT NULL,
     to_user_id INTEGER NOT NULL,
     amount INTEGER NOT NULL,
-    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    created_at INTEGER NOT NULL DEFAULT (unixepoch()),
     FOREIGN KEY(from_user_id) REFERENCES users(user_id),
     FOREIGN KEY(to_user_id) REFERENCES users(user_id)
 );
@@ -46,123 +54,399 @@ CREATE TABLE IF NOT EXISTS transactions (
     charge_id TEXT,
     description TEXT,
     balance_after INTEGER,
-    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    created_at INTEGER NOT NULL DEFAULT (unixepoch()),
     FOREIGN KEY(user_id) REFERENCES users(user_id),
     FOREIGN KEY(related_user_id) REFERENCES users(user_id)
 );
 
-CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_charge_id ON transactions(charge_id) WHERE charge_id IS NOT NULL;
-CREATE INDEX IF NOT EXISTS idx_transactions_user_created_at ON transactions(user_id, created_at DESC);
+-- A purchase and its refund share a charge_id, so uniqueness is per (charge_id, type).
+DROP INDEX IF EXISTS idx_transactions_charge_id;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_charge_type ON transactions(charge_id, type) WHERE charge_id IS NOT NULL;
+-- id breaks created_at ties, so it is part of the index and history pages never sort.
+DROP INDEX IF EXISTS idx_transactions_user_created_at;
+CREATE INDEX IF NOT EXISTS idx_transactions_user_created_id ON transactions(user_id, created_at DESC, id DESC);
 CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance DESC);
+CREATE INDEX IF NOT EXISTS idx_payments_user_amount_active ON payments(user_id, amount, created_at DESC) WHERE refunded=0;
 """
 
 
+# Bumped whenever an existing database needs MIGRATIONS to catch up with CREATE_SQL.
+# Each migration spells out its own DDL so later CREATE_SQL edits cannot change it;
+# indexes are left to CREATE_SQL, which runs after the migrations.
+SCHEMA_VERSION = 2
+
+# Version 1 stores timestamps as INTEGER unix seconds instead of ISO-8601 TEXT.
+# Column types cannot be altered in place, so the tables are rebuilt and the rows
+# copied across; the old indexes go with the old tables.
+MIGRATE_TO_UNIXEPOCH_SQL = """
+PRAGMA foreign_keys = OFF;
+BEGIN;
+ALTER TABLE users RENAME TO users_old;
+ALTER TABLE payments RENAME TO payments_old;
+ALTER TABLE transfers RENAME TO transfers_old;
+ALTER TABLE transactions RENAME TO transactions_old;
+
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    balance INTEGER NOT NULL DEFAULT 0,
+    created_at INTEGER NOT NULL DEFAULT (unixepoch()),
+    updated_at INTEGER NOT NULL DEFAULT (unixepoch())
+);
+CREATE TABLE payments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    currency TEXT NOT NULL,
+    charge_id TEXT NOT NULL UNIQUE,
+    refunded INTEGER NOT NULL DEFAULT 0,
+    created_at INTEGER NOT NULL DEFAULT (unixepoch()),
+    FOREIGN KEY(user_id) REFERENCES users(user_id)
+);
+CREATE TABLE transfers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    from_user_id INTEGER NOT NULL,
+    to_user_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    created_at INTEGER NOT NULL DEFAULT (unixepoch()),
+    FOREIGN KEY(from_user_id) REFERENCES users(user_id),
+    FOREIGN KEY(to_user_id) REFERENCES users(user_id)
+);
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    type TEXT NOT NULL CHECK(type IN ('purchase', 'gift_in', 'gift_out', 'refund')),
+    amount INTEGER NOT NULL,
+    related_user_id INTEGER,
+    charge_id TEXT,
+    description TEXT,
+    balance_after INTEGER,
+    created_at INTEGER NOT NULL DEFAULT (unixepoch()),
+    FOREIGN KEY(user_id) REFERENCES users(user_id),
+    FOREIGN KEY(related_user_id) REFERENCES users(user_id)
+);
+
+INSERT INTO users(user_id, username, balance, created_at, updated_at)
+SELECT user_id, username, balance, unixepoch(created_at), unixepoch(updated_at) FROM users_old;
+INSERT INTO payments(id, user_id, amount, currency, charge_id, refunded, created_at)
+SELECT id, user_id, amount, currency, charge_id, refunded, unixepoch(created_at) FROM payments_old;
+INSERT INTO transfers(id, from_user_id, to_user_id, amount, created_at)
+SELECT id, from_user_id, to_user_id, amount, unixepoch(created_at) FROM transfers_old;
+INSERT INTO transactions(id, user_id, type, amount, related_user_id, charge_id, description, balance_after, created_at)
+SELECT id, user_id, type, amount, related_user_id, charge_id, description, balance_after, unixepoch(created_at)
+FROM transactions_old;
+
+DROP TABLE transactions_old;
+DROP TABLE transfers_old;
+DROP TABLE payments_old;
+DROP TABLE users_old;
+PRAGMA user_version = 1;
+COMMIT;
+PRAGMA foreign_keys = ON;
+"""
+
+# Version 2 keeps a per-user transaction count next to the balance.
+MIGRATE_TX_COUNT_SQL = """
+BEGIN;
+ALTER TABLE users ADD COLUMN tx_count INTEGER NOT NULL DEFAULT 0;
+UPDATE users SET tx_count = (SELECT COUNT(*) FROM transactions WHERE transactions.user_id = users.user_id);
+PRAGMA user_version = 2;
+COMMIT;
+"""
+
+MIGRATIONS = {1: MIGRATE_TO_UNIXEPOCH_SQL, 2: MIGRATE_TX_COUNT_SQL}
+
+# Applied once per pooled connection. synchronous=NORMAL is durable against
+# application crashes in WAL mode; only an OS crash can lose the last commits.
 PRAGMAS = [
     "PRAGMA foreign_keys = ON;",
     "PRAGMA journal_mode = WAL;",
     "PRAGMA busy_timeout = 5000;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA cache_size = -64000;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA mmap_size = 268435456;",
+    "PRAGMA wal_autocheckpoint = 1000;",
 ]
 
+# Hot statements live in constants so every call hands sqlite3 the same SQL text
+# and hits the per-connection prepared statement cache.
+SQL_UPSERT_USER = """
+INSERT INTO users(user_id, username)
+VALUES(?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+    username=COALESCE(excluded.username, users.username),
+    updated_at=unixepoch()
+"""
+SQL_UPSERT_USER_RETURNING_BALANCE = SQL_UPSERT_USER + "RETURNING balance"
+# Both sides of a transfer in one statement.
+SQL_UPSERT_USER_PAIR = SQL_UPSERT_USER.replace("VALUES(?, ?)", "VALUES(?, ?), (?, ?)")
+SQL_CREDIT_USER = """
+INSERT INTO users(user_id, username, balance, tx_count)
+VALUES(?, ?, ?, 1)
+ON CONFLICT(user_id) DO UPDATE SET
+    username=COALESCE(excluded.username, users.username),
+    balance=users.balance + excluded.balance,
+    tx_count=users.tx_count + 1,
+    updated_at=unixepoch()
+RETURNING balance
+"""
+SQL_INSERT_PAYMENT = """
+INSERT INTO payments(user_id, amount, currency, charge_id, refunded)
+VALUES(?, ?, 'XTR', ?, 0)
+"""
+SQL_CLAIM_REFUND = """
+UPDATE payments SET refunded=1
+WHERE charge_id=? AND user_id=? AND amount=? AND refunded=0
+"""
+SQL_GET_BALANCE = "SELECT balance FROM users WHERE user_id=?"
+# Every balance change writes exactly one transaction row for that user, so the
+# balance statements also keep users.tx_count in step.
+SQL_DEBIT = """
+UPDATE users
+SET balance = balance - ?, tx_count = tx_count + 1, updated_at=unixepoch()
+WHERE user_id=? AND balance >= ?
+RETURNING balance
+"""
+# Debits the sender and credits the receiver in one pass. The sender row only
+# matches while it can cover the amount, so a missing sender in RETURNING
+# means insufficient funds.
+SQL_TRANSFER = """
+UPDATE users
+SET balance = balance + CASE WHEN user_id=? THEN ? ELSE ? END, tx_count = tx_count + 1, updated_at=unixepoch()
+WHERE user_id IN (?, ?) AND (user_id != ? OR balance >= ?)
+RETURNING user_id, balance
+"""
+SQL_GET_TRANSACTIONS = """
+SELECT id, type, amount, related_user_id, charge_id, description, balance_after, created_at
+FROM transactions
+WHERE user_id=?
+ORDER BY created_at DESC, id DESC
+LIMIT ? OFFSET ?
+"""
+SQL_GET_TRANSACTIONS_BEFORE = """
+SELECT id, type, amount, related_user_id, charge_id, description, balance_after, created_at
+FROM transactions
+WHERE user_id=? AND (created_at, id) < (SELECT created_at, id FROM transactions WHERE id=?)
+ORDER BY created_at DESC, id DESC
+LIMIT ? OFFSET ?
+"""
+SQL_PAYMENT_EXISTS = "SELECT EXISTS(SELECT 1 FROM payments WHERE charge_id=?)"
+SQL_INSERT_TRANSACTION = """
+INSERT INTO transactions(user_id, type, amount, related_user_id, charge_id, description, balance_after)
+VALUES(?, ?, ?, ?, ?, ?, ?)
+"""
+
+STATEMENT_CACHE_SIZE = 256
+# Each aiosqlite connection is a dedicated thread; a handful covers the reads a
+# single event loop can issue, and more threads only add switching.
+READER_POOL_SIZE = min(8, (os.cpu_count() or 4) + 2)
+BALANCE_CACHE_TTL = 2.0
+BALANCE_CACHE_MAX_ENTRIES = 10_000
+# PRAGMA optimize refreshes planner statistics for tables whose contents shifted.
+OPTIMIZE_INTERVAL = 3600.0
+
+
+# Readers return plain tuples; these give the hot result sets field names without
+# building a Row or dict per record. Field order matches the SELECT column order.
+class Transaction(NamedTuple):
+    id: int
+    type: str
+    amount: int
+    related_user_id: Optional[int]
+    charge_id: Optional[str]
+    description: Optional[str]
+    balance_after: Optional[int]
+    created_at: int
+
+
+class TopEntry(NamedTuple):
+    user_id: int
+    username: Optional[str]
+    balance: int
+
+
+class Payment(NamedTuple):
+    id: int
+    charge_id: str
+    refunded: int
+    amount: int
+
+
+def format_timestamp(value: int) -> str:
+    """Renders a stored unix timestamp the way the bot and API have always shown it."""
+    return datetime.fromtimestamp(value, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
 
 class Database:
-    def __init__(self, path: str):
+    def __init__(self, path: str, readers: int = READER_POOL_SIZE):
         self.path = Path(path)
         if self.path.parent:
             os.makedirs(self.path.parent, exist_ok=True)
-
-    async def _connect(self) -> aiosqlite.Connection:
-        conn = await aiosqlite.connect(self.path)
-        conn.row_factory = aiosqlite.Row
+        # Long-lived connections: PRAGMAs run once per connection and SQLite keeps
+        # its page cache warm between queries. WAL lets the readers run alongside
+        # the single writer.
+        self._reader_count = readers
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._reader_connections: List[aiosqlite.Connection] = []
+        self._writer: Optional[aiosqlite.Connection] = None
+        # Bumped after every committed write; lets read caches detect stale entries.
+        self.generation = 0
+        # SQLite allows a single writer; queue writes here instead of in busy_timeout.
+        self._write_lock = asyncio.Lock()
+        # user_id -> (balance, expires_at); absorbs repeated reads between writes.
+        self._balance_cache: Dict[int, Tuple[int, float]] = {}
+        self._optimize_task: Optional[asyncio.Task] = None
+
+    async def _connect(self, readonly: bool = False) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
         for pragma in PRAGMAS:
             await conn.execute(pragma)
+        if readonly:
+            await conn.execute("PRAGMA query_only = ON;")
+        else:
+            conn.row_factory = aiosqlite.Row
         return conn
 
+    @asynccontextmanager
+    async def connection(self, readonly: bool = False) -> AsyncIterator[aiosqlite.Connection]:
+        if readonly:
+            conn = await self._readers.get()
+            try:
+                yield conn
+            finally:
+                self._readers.put_nowait(conn)
+            return
+        async with self._write_lock:
+            conn = self._writer
+            try:
+                yield conn
+            finally:
+                # Never leave a half-done transaction on the shared writer.
+                if conn.in_transaction:
+                    await conn.rollback()
+
+    def _cache_balance(self, user_id: int, balance: int) -> None:
+        # Re-inserting moves the entry to the end, so the first key is always the
+        # least recently written one and the cap evicts it alone.
+        self._balance_cache.pop(user_id, None)
+        if len(self._balance_cache) >= BALANCE_CACHE_MAX_ENTRIES:
+            del self._balance_cache[next(iter(self._balance_cache))]
+        self._balance_cache[user_id] = (balance, time.monotonic() + BALANCE_CACHE_TTL)
+
+    def _after_write(self, balances: Optional[Dict[int, int]] = None) -> None:
+        # Write-through: the balances come from RETURNING in the committed
+        # transaction, so the next get_balance for these users skips the database.
+        self.generation += 1
+        for user_id, balance in (balances or {}).items():
+            self._cache_balance(user_id, balance)
+
     async def init(self) -> None:
-        conn = await self._connect()
-        try:
-            await conn.executescript(CREATE_SQL)
-            await conn.commit()
-        finally:
+        self._writer = await self._connect()
+        await self._migrate(self._writer)
+        await self._writer.executescript(CREATE_SQL)
+        await self._writer.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        await self._writer.commit()
+        for _ in range(self._reader_count):
+            conn = await self._connect(readonly=True)
+            self._reader_connections.append(conn)
+            self._readers.put_nowait(conn)
+        self._optimize_task = asyncio.create_task(self._optimize_loop())
+
+    async def _optimize(self) -> None:
+        async with self.connection() as conn:
+            await conn.execute("PRAGMA optimize;")
+
+    async def _optimize_loop(self) -> None:
+        while True:
+            await asyncio.sleep(OPTIMIZE_INTERVAL)
+            try:
+                await self._optimize()
+            except sqlite3.Error:
+                logger.exception("PRAGMA optimize failed")
+
+    async def _migrate(self, conn: aiosqlite.Connection) -> None:
+        cur = await conn.execute("PRAGMA user_version;")
+        version = (await cur.fetchone())[0]
+        cur = await conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users'")
+        if await cur.fetchone() is None:
+            # Fresh database: CREATE_SQL already builds the latest schema.
+            return
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            await conn.executescript(MIGRATIONS[target])
+
+    async def close(self) -> None:
+        if self._optimize_task is not None:
+            self._optimize_task.cancel()
+            try:
+                await self._optimize_task
+            except asyncio.CancelledError:
+                pass
+            self._optimize_task = None
+        if self._writer is not None:
+            await self._optimize()
+        for conn in self._reader_connections:
             await conn.close()
+        self._reader_connections.clear()
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
 
     async def ensure_user(self, user_id: int, username: Optional[str]) -> None:
-        conn = await self._connect()
-        try:
-            await conn.execute(
-                """
-                INSERT INTO users(user_id, username)
-                VALUES(?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET
-                    username=COALESCE(excluded.username, users.username),
-                    updated_at=datetime('now')
-                """,
-                (user_id, username),
-            )
+        async with self.connection() as conn:
+            await conn.execute(SQL_UPSERT_USER, (user_id, username))
             await conn.commit()
-        finally:
-            await conn.close()
+            self._after_write()
 
-    async def _ensure_user_tx(self, conn: aiosqlite.Connection, user_id: int, username: Optional[str]) -> None:
-        await conn.execute(
-            """
-            INSERT INTO users(user_id, username)
-            VALUES(?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username=COALESCE(excluded.username, users.username),
-                updated_at=datetime('now')
-            """,
-            (user_id, username),
-        )
+    async def ensure_user_returning_balance(self, user_id: int, username: Optional[str]) -> int:
+        async with self.connection() as conn:
+            cur = await conn.execute(SQL_UPSERT_USER_RETURNING_BALANCE, (user_id, username))
+            row = await cur.fetchone()
+            await conn.commit()
+            balance = int(row["balance"])
+            self._after_write({user_id: balance})
+        return balance
 
     async def get_balance(self, user_id: int) -> int:
-        conn = await self._connect()
-        try:
-            cur = await conn.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
+        cached = self._balance_cache.get(user_id)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        generation = self.generation
+        async with self.connection(readonly=True) as conn:
+            cur = await conn.execute(SQL_GET_BALANCE, (user_id,))
             row = await cur.fetchone()
-            return int(row["balance"]) if row else 0
-        finally:
-            await conn.close()
-
-    async def _get_balance_tx(self, conn: aiosqlite.Connection, user_id: int) -> int:
-        cur = await conn.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
+            balance = int(row[0]) if row else 0
+        if generation == self.generation:
+            self._cache_balance(user_id, balance)
+        return balance
+
+    async def _debit_tx(self, conn: aiosqlite.Connection, user_id: int, amount: int) -> Optional[int]:
+        # Check and decrement in one statement so concurrent debits can never
+        # take the balance below zero. Returns None when the balance is short.
+        cur = await conn.execute(SQL_DEBIT, (amount, user_id, amount))
         row = await cur.fetchone()
-        return int(row["balance"]) if row else 0
+        return int(row[0]) if row else None
 
     async def payment_exists(self, charge_id: str) -> bool:
-        conn = await self._connect()
-        try:
-            cur = await conn.execute("SELECT 1 FROM payments WHERE charge_id=?", (charge_id,))
-            return await cur.fetchone() is not None
-        finally:
-            await conn.close()
-
-    async def add_purchase(self, user_id: int, username: Optional[str], amount: int, charge_id: str) -> bool:
-        conn = await self._connect()
-        try:
-            await conn.execute("BEGIN")
-            await self._ensure_user_tx(conn, user_id, username)
-
-            cur = await conn.execute("SELECT id, refunded FROM payments WHERE charge_id=?", (charge_id,))
-            if await cur.fetchone():
+        async with self.connection(readonly=True) as conn:
+            cur = await conn.execute(SQL_PAYMENT_EXISTS, (charge_id,))
+            return bool((await cur.fetchone())[0])
+
+    async def add_purchase(
+        self, user_id: int, username: Optional[str], amount: int, charge_id: str
+    ) -> Optional[int]:
+        async with self.connection() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            # Creates the user if needed and credits them in one statement.
+            cur = await conn.execute(SQL_CREDIT_USER, (user_id, username, amount))
+            balance_after = int((await cur.fetchone())["balance"])
+            try:
+                await conn.execute(SQL_INSERT_PAYMENT, (user_id, amount, charge_id))
+            except sqlite3.IntegrityError:
+                # charge_id is UNIQUE: Telegram redelivered a payment we already applied.
                 await conn.rollback()
-                return False
-
-            await conn.execute(
-                """
-                INSERT INTO payments(user_id, amount, currency, charge_id, refunded)
-                VALUES(?, ?, 'XTR', ?, 0)
-                """,
-                (user_id, amount, charge_id),
-            )
-            await conn.execute(
-                """
-                UPDATE users
-                SET balance = balance + ?, updated_at=datetime('now')
-                WHERE user_id=?
-                """,
-                (amount, user_id),
-            )
-            balance_after = await self._get_balance_tx(conn, user_id)
+                return None
             await self._insert_transaction(
                 conn,
                 user_id=user_id,
@@ -173,95 +457,64 @@ class Database:
                 balance_after=balance_after,
             )
             await conn.commit()
-            return True
-        finally:
-            await conn.close()
+            self._after_write({user_id: balance_after})
+            return balance_after
 
     async def transfer(
         self, from_user: int, to_user: int, amount: int, from_username: Optional[str], to_username: Optional[str]
     ) -> int:
         if amount <= 0:
             raise ValueError("amount must be positive")
+        if from_user == to_user:
+            raise ValueError("cannot transfer to self")
 
-        conn = await self._connect()
-        try:
-            await conn.execute("BEGIN")
-            await self._ensure_user_tx(conn, from_user, from_username)
-            await self._ensure_user_tx(conn, to_user, to_username)
+        async with self.connection() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            await conn.execute(SQL_UPSERT_USER_PAIR, (from_user, from_username, to_user, to_username))
 
-            sender_balance = await self._get_balance_tx(conn, from_user)
-            if sender_balance < amount:
+            cur = await conn.execute(
+                SQL_TRANSFER,
+                (from_user, -amount, amount, from_user, to_user, from_user, amount),
+            )
+            balances = {row["user_id"]: int(row["balance"]) for row in await cur.fetchall()}
+            if from_user not in balances:
                 await conn.rollback()
                 raise ValueError("insufficient_funds")
+            sender_after, receiver_after = balances[from_user], balances[to_user]
 
             await conn.execute(
-                "UPDATE users SET balance = balance - ?, updated_at=datetime('now') WHERE user_id=?",
-                (amount, from_user),
-            )
-            await conn.execute(
-                "UPDATE users SET balance = balance + ?, updated_at=datetime('now') WHERE user_id=?",
-                (amount, to_user),
-            )
-
-            transfer_cur = await conn.execute(
                 "INSERT INTO transfers(from_user_id, to_user_id, amount) VALUES(?, ?, ?)",
                 (from_user, to_user, amount),
             )
-            transfer_id = transfer_cur.lastrowid
 
-            sender_after = await self._get_balance_tx(conn, from_user)
-            receiver_after = await self._get_balance_tx(conn, to_user)
-            await self._insert_transaction(
+            await self._insert_transactions_bulk(
                 conn,
-                user_id=from_user,
-                tx_type="gift_out",
-                amount=amount,
-                related_user_id=to_user,
-                description=f"Подарок {amount}⭐ пользователю {to_user}",
-                balance_after=sender_after,
-            )
-            await self._insert_transaction(
-                conn,
-                user_id=to_user,
-                tx_type="gift_in",
-                amount=amount,
-                related_user_id=from_user,
-                description=f"Получен подарок {amount}⭐ от пользователя {from_user}",
-                balance_after=receiver_after,
+                [
+                    (
+                        from_user, "gift_out", amount, to_user, None,
+                        f"Подарок {amount}⭐ пользователю {to_user}", sender_after,
+                    ),
+                    (
+                        to_user, "gift_in", amount, from_user, None,
+                        f"Получен подарок {amount}⭐ от пользователя {from_user}", receiver_after,
+                    ),
+                ],
             )
             await conn.commit()
-            return transfer_id
-        finally:
-            await conn.close()
+            self._after_write({from_user: sender_after, to_user: receiver_after})
+            return sender_after
 
     async def mark_refund(self, user_id: int, charge_id: str, amount: int) -> bool:
-        conn = await self._connect()
-        try:
-            await conn.execute("BEGIN")
-            cur = await conn.execute(
-                "SELECT id, amount, refunded FROM payments WHERE charge_id=? AND user_id=?",
-                (charge_id, user_id),
-            )
-            row = await cur.fetchone()
-            if not row or row["refunded"]:
-                await conn.rollback()
-                return False
-
-            if int(row["amount"]) != int(amount):
+        async with self.connection() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            # Matches only an unrefunded payment of exactly this amount, so a
+            # second refund of the same charge finds nothing to update.
+            cur = await conn.execute(SQL_CLAIM_REFUND, (charge_id, user_id, amount))
+            balance_after = await self._debit_tx(conn, user_id, amount) if cur.rowcount == 1 else None
+            if balance_after is None:
                 await conn.rollback()
                 return False
 
-            current_balance = await self._get_balance_tx(conn, user_id)
-            if current_balance < amount:
-                await conn.rollback()
-                return False
-
-            await conn.execute("UPDATE payments SET refunded=1 WHERE id=?", (row["id"],))
-            await conn.execute(
-                "UPDATE users SET balance = balance - ?, updated_at=datetime('now') WHERE user_id=?",
-                (amount, user_id),
-            )
-            balance_after = await self._get_balance_tx(conn, user_id)
             await self._insert_transaction(
                 conn,
                 user_id=user_id,
@@ -272,9 +525,8 @@ class Database:
                 balance_after=balance_after,
             )
             await conn.commit()
+            self._after_write({user_id: balance_after})
             return True
-        finally:
-            await conn.close()
 
     async def _insert_transaction(
         self,
@@ -288,29 +540,32 @@ class Database:
         balance_after: Optional[int] = None,
     ) -> None:
         await conn.execute(
-            """
-            INSERT INTO transactions(user_id, type, amount, related_user_id, charge_id, description, balance_after)
-            VALUES(?, ?, ?, ?, ?, ?, ?)
-            """,
+            SQL_INSERT_TRANSACTION,
             (user_id, tx_type, amount, related_user_id, charge_id, description, balance_after),
         )
 
+    async def _insert_transactions_bulk(
+        self, conn: aiosqlite.Connection, rows: List[Tuple[Any, ...]]
+    ) -> None:
+        # One multi-row INSERT instead of a round-trip per row. Each row follows
+        # the column order of SQL_INSERT_TRANSACTION.
+        placeholders = ", ".join(["(?, ?, ?, ?, ?, ?, ?)"] * len(rows))
+        await conn.execute(
+            "INSERT INTO transactions(user_id, type, amount, related_user_id, charge_id, description, balance_after) "
+            f"VALUES {placeholders}",
+            [value for row in rows for value in row],
+        )
+
     async def debit_balance(self, user_id: int, amount: int, reason: Optional[str] = None) -> int:
         if amount <= 0:
             raise ValueError("amount must be positive")
-        conn = await self._connect()
-        try:
-            await conn.execute("BEGIN")
-            await self._ensure_user_tx(conn, user_id, None)
-            current_balance = await self._get_balance_tx(conn, user_id)
-            if current_balance < amount:
+        async with self.connection() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            # No upsert first: a user without a row has nothing to debit anyway.
+            balance_after = await self._debit_tx(conn, user_id, amount)
+            if balance_after is None:
                 await conn.rollback()
                 raise ValueError("insufficient_funds")
-            await conn.execute(
-                "UPDATE users SET balance = balance - ?, updated_at=datetime('now') WHERE user_id=?",
-                (amount, user_id),
-            )
-            balance_after = await self._get_balance_tx(conn, user_id)
             await self._insert_transaction(
                 conn,
                 user_id=user_id,
@@ -320,55 +575,40 @@ class Database:
                 balance_after=balance_after,
             )
             await conn.commit()
+            self._after_write({user_id: balance_after})
             return balance_after
-        finally:
-            await conn.close()
 
-    async def get_transactions(self, user_id: int, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
-        conn = await self._connect()
-        try:
-            cur = await conn.execute(
-                """
-                SELECT id, type, amount, related_user_id, charge_id, description, balance_after, created_at
-                FROM transactions
-                WHERE user_id=?
-                ORDER BY created_at DESC, id DESC
-                LIMIT ? OFFSET ?
-                """,
-                (user_id, limit, offset),
-            )
+    async def get_transactions(
+        self, user_id: int, limit: int = 20, offset: int = 0, before_id: Optional[int] = None
+    ) -> List[Transaction]:
+        # before_id is a keyset cursor: the id of the last row of the previous
+        # page. Seeking to it costs the same on every page, unlike OFFSET, which
+        # walks and discards all the skipped rows.
+        async with self.connection(readonly=True) as conn:
+            if before_id is None:
+                cur = await conn.execute(SQL_GET_TRANSACTIONS, (user_id, limit, offset))
+            else:
+                cur = await conn.execute(SQL_GET_TRANSACTIONS_BEFORE, (user_id, before_id, limit, offset))
             rows = await cur.fetchall()
-            return [dict(row) for row in rows]
-        finally:
-            await conn.close()
+            return [Transaction(*row) for row in rows]
 
     async def count_transactions(self, user_id: int) -> int:
-        conn = await self._connect()
-        try:
-            cur = await conn.execute(
-                "SELECT COUNT(*) AS cnt FROM transactions WHERE user_id=?",
-                (user_id,),
-            )
+        async with self.connection(readonly=True) as conn:
+            cur = await conn.execute("SELECT tx_count FROM users WHERE user_id=?", (user_id,))
             row = await cur.fetchone()
-            return int(row["cnt"]) if row else 0
-        finally:
-            await conn.close()
+            return int(row[0]) if row else 0
 
-    async def top_balances(self, limit: int = 50) -> List[Dict[str, Any]]:
-        conn = await self._connect()
-        try:
+    async def top_balances(self, limit: int = 50) -> List[TopEntry]:
+        async with self.connection(readonly=True) as conn:
             cur = await conn.execute(
                 "SELECT user_id, username, balance FROM users ORDER BY balance DESC LIMIT ?",
                 (limit,),
             )
             rows = await cur.fetchall()
-            return [dict(row) for row in rows]
-        finally:
-            await conn.close()
+            return [TopEntry(*row) for row in rows]
 
-    async def get_payment_for_amount(self, user_id: int, amount: int) -> Optional[Dict[str, Any]]:
-        conn = await self._connect()
-        try:
+    async def get_payment_for_amount(self, user_id: int, amount: int) -> Optional[Payment]:
+        async with self.connection(readonly=True) as conn:
             cur = await conn.execute(
                 """
                 SELECT id, charge_id, refunded, amount
@@ -380,6 +620,21 @@ class Database:
                 (user_id, amount),
             )
             row = await cur.fetchone()
-            return dict(row) if row else None
-        finally:
-            await conn.close()
+            return Payment(*row) if row else None
+
+    async def refundable_amounts(self, user_id: int, amounts: Iterable[int]) -> Set[int]:
+        candidates = list(amounts)
+        if not candidates:
+            return set()
+        placeholders = ", ".join("?" for _ in candidates)
+        async with self.connection(readonly=True) as conn:
+            cur = await conn.execute(
+                f"""
+                SELECT DISTINCT amount
+                FROM payments
+                WHERE user_id=? AND refunded=0 AND amount IN ({placeholders})
+                """,
+                (user_id, *candidates),
+            )
+            rows = await cur.fetchall()
+            return {int(row[0]) for row in rows}
@@ -7,6 +7,11 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 
+try:
+    import uvloop
+except ImportError:  # uvloop has no Windows build
+    uvloop = None
+
 from api.routes import create_api_app
 from bot.handlers import setup_handlers
 from config.logger import log_extra, setup_logging
@@ -14,7 +19,15 @@ from config.settings import Settings
 from db.database import Database
 
 
-async def run_bot(bot: Bot, dp: Dispatcher) -> None:
+async def run_bot(bot: Bot, dp: Dispatcher, settings: Settings) -> None:
+    if settings.use_webhook:
+        await bot.set_webhook(
+            url=f"{settings.webhook_url}{settings.webhook_path}",
+            drop_pending_updates=True,
+            secret_token=settings.webhook_secret,
+        )
+        logging.getLogger(__name__).info("bot started", extra=log_extra(mode="webhook"))
+        return
     await bot.delete_webhook(drop_pending_updates=True)
     logging.getLogger(__name__).info("bot started", extra=log_extra(mode="polling"))
     await dp.start_polling(bot)
@@ -33,18 +46,33 @@ async def main() -> None:
     dp = Dispatcher(storage=MemoryStorage())
     setup_handlers(dp, db, settings)
 
-    api_app = create_api_app(settings, db, bot)
-    api_config = uvicorn.Config(api_app, host=settings.host, port=settings.port, log_level="info")
+    api_app = create_api_app(settings, db, bot, dp)
+    # Access logging formats and writes a record on every request; errors still log.
+    api_config = uvicorn.Config(
+        api_app,
+        host=settings.host,
+        port=settings.port,
+        log_level="warning",
+        access_log=False,
+        http="httptools",
+        lifespan="on",
+    )
     api_server = uvicorn.Server(api_config)
 
-    bot_task = asyncio.create_task(run_bot(bot, dp))
+    bot_task = asyncio.create_task(run_bot(bot, dp, settings))
     api_task = asyncio.create_task(api_server.serve())
 
     try:
         await asyncio.gather(bot_task, api_task)
     except asyncio.CancelledError:
         pass
+    finally:
+        await db.close()
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        # Bot and API share this loop, so the policy covers both; uvicorn's own
+        # loop= setting only applies when it creates the loop itself.
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())